@@ -1,21 +1,24 @@
-import argparse, os, time, datetime as dt
+import argparse, asyncio, os, time, queue, random
 import store
 import json
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, List, Tuple
 from dotenv import load_dotenv
-from gmail_connector import init_oauth, gmail_service, fetch_recent_threads, fetch_thread_messages_text
-from triage import load_schema_dynamic, triage_thread
-from digest import render_digest, send_digest_via_gmail_api
 
-def header_value(msg, name: str) -> str:
-    headers = (msg.get("payload", {}) or {}).get("headers", []) or []
-    for h in headers:
-        if (h.get("name", "") or "").lower() == name.lower():
-            return h.get("value", "") or ""
-    return ""
+# Gmail watches expire after 7 days; renew a day early
+WATCH_RENEW_S = 6 * 24 * 3600
+# How often --watch checks that the Pub/Sub stream is still alive
+WATCH_CHECK_S = 60
+# Syncs a thread whose fetch or triage failed is retried in before it is dropped
+WATCH_MAX_RETRIES = 5
+# Ceiling for the idle --poll backoff
+POLL_MAX_SLEEP_S = 3600
 
 def now_iso():
-    return dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+    # Same "2024-01-31T12:00:00Z" format, formatted in C without a datetime object
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
 def main():
     load_dotenv()
@@ -23,6 +26,7 @@ def main():
     p.add_argument("--init", action="store_true")
     p.add_argument("--run-once", action="store_true")
     p.add_argument("--poll", action="store_true")
+    p.add_argument("--watch", action="store_true", help="Follow Gmail push notifications via Pub/Sub instead of polling")
     p.add_argument("--interval-min", type=int, default=10)
     p.add_argument("--done", type=int, help="Mark a task id as done")
     p.add_argument("--list", action="store_true", help="List open tasks")
@@ -35,52 +39,67 @@ def main():
     token_path = os.path.join("secrets","token.json")
 
     if args.init:
+        from gmail_connector import init_oauth
         init_oauth(client_secret, token_path)
         print("OAuth complete. Token stored at secrets/token.json")
         return
 
-    user = os.getenv("GMAIL_USER","").strip()
-    if not user:
-        raise RuntimeError("Set GMAIL_USER in .env")
-    digest_to_email = os.getenv("DIGEST_TO_EMAIL", "").strip()
-    if not digest_to_email:
-        raise RuntimeError("Set DIGEST_TO_EMAIL in .env")
-    digest_subject_prefix = os.getenv("DIGEST_SUBJECT_PREFIX", "EIMVP DIGEST")
-
-    creds = init_oauth(client_secret, token_path)
-    svc = gmail_service(creds)
-
     os.makedirs("data", exist_ok=True)
     conn = store.connect(os.path.join("data","state.sqlite"))
-    schema = load_schema_dynamic("schema.json")
 
+    # Local-only commands: answer from SQLite without OAuth or the Google/LLM imports
     if args.done:
-        store.mark_task_done(conn, args.done)
+        with store.transaction(conn):
+            store.mark_task_done(conn, args.done)
         print(f"Marked task {args.done} as done.")
         return
-    
+
     if args.list:
-        tasks = store.fetch_open_tasks(conn)
+        # Only the head is printed; let SQLite stop there via the ordered index
+        tasks = store.fetch_open_tasks(conn, limit=200)
         if not tasks:
             print("No open tasks ✅")
             return
 
         print("\nOpen tasks:")
-        for t in tasks[:200]:
-            due = t.get("due_date") or "—"
-            bucket = t.get("bucket") or "—"
-            subj = (t.get("thread_subject") or "—").strip()
-            title = (t.get("title") or "").strip()
-            pr = (t.get("priority") or "").strip()
+        for t in tasks:
+            due = t["due_date"] or "—"
+            bucket = t["bucket"] or "—"
+            subj = (t["thread_subject"] or "—").strip()
+            title = (t["title"] or "").strip()
+            pr = (t["priority"] or "").strip()
 
             print(f"#{t['id']:>4}  [{pr:<6}]  due {due:<10}  {bucket:<18}  {title}")
             print(f"      subj: {subj}")
         return
 
+    # Deferred: google-api-python-client, jsonschema and requests are slow to import
+    from gmail_connector import BATCH_LIMIT, init_oauth, gmail_service, extract_subject_and_history_id, fetch_recent_threads, fetch_threads, thread_messages_text, fetch_history_thread_ids, start_watch
+    from triage import load_schema_dynamic, schema_version, triage_cache_key, triage_thread, triage_threads_batch
+    from digest import render_digest, send_digest_via_gmail_api
+
+    user = os.getenv("GMAIL_USER","").strip()
+    if not user:
+        raise RuntimeError("Set GMAIL_USER in .env")
+    digest_to_email = os.getenv("DIGEST_TO_EMAIL", "").strip()
+    if not digest_to_email:
+        raise RuntimeError("Set DIGEST_TO_EMAIL in .env")
+    digest_subject_prefix = os.getenv("DIGEST_SUBJECT_PREFIX", "EIMVP DIGEST")
+
+    creds = init_oauth(client_secret, token_path)
+    svc = gmail_service(creds)
+
+    schema = load_schema_dynamic("schema.json")
+
     lookback_days = int(os.getenv("LOOKBACK_DAYS","2"))
     max_threads = int(os.getenv("MAX_THREADS_PER_RUN","50"))
     conf_thr = float(os.getenv("CONFIDENCE_THRESHOLD","0.55"))
+    cache_days = int(os.getenv("TRIAGE_CACHE_DAYS","30"))
     send_digest = os.getenv("SEND_DIGEST","true").lower() == "true"
+    headers_only = os.getenv("TRIAGE_HEADERS_ONLY","false").lower() == "true"
+    triage_concurrency = max(1, int(os.getenv("TRIAGE_CONCURRENCY","8")))
+    llm_model = os.getenv("LLM_MODEL","simulate")
+    digest_tag = f"[{digest_subject_prefix}]"
 
     def run_demo(conn, schema, demo_path: str, preview_html_path: str):
         with open(demo_path, "r", encoding="utf-8") as f:
@@ -91,21 +110,22 @@ def main():
 
         now = now_iso()
 
-        for th in threads:
-            tid = th["thread_id"]
-            subject = th.get("subject", "")
-            latest_history_id = th.get("latest_history_id", tid)
-            msgs = th.get("messages", [])
+        with store.transaction(conn):
+            for th in threads:
+                tid = th["thread_id"]
+                subject = th.get("subject", "")
+                latest_history_id = th.get("latest_history_id", tid)
+                msgs = th.get("messages", [])
 
-            # mimic the real pipeline storage
-            store.upsert_thread(conn, "demo", tid, subject, now, str(latest_history_id))
+                # mimic the real pipeline storage
+                store.upsert_thread(conn, "demo", tid, subject, now, str(latest_history_id))
 
-            # triage using your existing LLM pipeline
-            out = triage_thread(subject, msgs, schema)
+                # triage using your existing LLM pipeline
+                out = triage_thread(subject, msgs, schema)
 
-            # record + tasks
-            store.record_triage(conn, "demo", tid, now, os.getenv("LLM_MODEL",""), float(out.get("confidence", 0.5)), str(latest_history_id), out)
-            store.create_tasks_from_actions(conn, "demo", tid, now, out)
+                # record + tasks
+                store.record_triage(conn, "demo", tid, now, llm_model, float(out.get("confidence", 0.5)), str(latest_history_id), out)
+                store.create_tasks_from_actions(conn, "demo", tid, now, out)
 
         tasks = store.fetch_open_tasks(conn)
         html = render_digest(tasks)
@@ -120,49 +140,240 @@ def main():
         run_demo(conn, schema, args.demo, args.preview_html)
         return
 
-    def cycle():
-        threads = fetch_recent_threads(svc, user, lookback_days=lookback_days, max_threads=max_threads)
-        print(f"[{now_iso()}] fetched {len(threads)} threads")
-        for th in threads:
-            tid = th["id"]
-
-            # Subject logic to account for snippet missing subject
-            subject = "(no subject)"
-            msgs_meta = th.get("messages", []) or []
-            latest_history_id = None
-            if msgs_meta:
-                # Usually subject is on the first message in the thread
-                subject = header_value(msgs_meta[0], "Subject") or "(no subject)"
-                latest_history_id = msgs_meta[-1].get("historyId")  # newest message
+    async def process_threads(threads, requested: List[str] = ()) -> Tuple[int, List[str]]:
+        # `threads` streams in Gmail batches of full threads; each wave is gated with
+        # one IN-query and the bodies are read straight off the same responses.
+        # Returns (threads triaged, ids to retry): ids whose triage failed, plus any
+        # of `requested` that never came back from Gmail.
+        it = iter(threads)
+        seen, work, bodies, fetched = 0, [], {}, set()
+        while True:
+            wave = list(islice(it, BATCH_LIMIT))
+            if not wave:
+                break
+            seen += len(wave)
+            fetched.update(th["id"] for th in wave)
+
+            metas = []
+            for th in wave:
+                tid = th["id"]
+                subject, latest_history_id = extract_subject_and_history_id(th)
+                # History sync sees every INBOX arrival, including our own digests
+                if subject.startswith(digest_tag):
+                    continue
+                metas.append((tid, subject, latest_history_id))
+
+            # Skip threads that haven't changed since they were last triaged
+            needs = store.filter_threads_needing_analysis(
+                conn, "gmail", {tid: hid for tid, _, hid in metas if hid})
+            by_id = {th["id"]: th for th in wave}
+            for m in metas:
+                if not m[2] or m[0] in needs:
+                    bodies[m[0]] = thread_messages_text(by_id[m[0]], max_messages=6, headers_only=headers_only)
+                    work.append(m)
+        print(f"[{now_iso()}] fetched {seen} threads, {len(work)} to triage")
+
+        # Unchanged thread content (e.g. re-seen after a restart) reuses the cached triage
+        keys = {tid: triage_cache_key(subject, bodies[tid], schema) for tid, subject, _ in work}
+        cached = store.fetch_cached_triage(conn, list(keys.values()))
+        misses = [(tid, subject) for tid, subject, _ in work if keys[tid] not in cached]
+
+        # LLM calls are independent and latency-bound: run up to TRIAGE_CONCURRENCY at once
+        outs = await triage_threads_batch([(subject, bodies[tid]) for tid, subject in misses], schema, triage_concurrency) if misses else []
+        fresh, retry = {}, [tid for tid in requested if tid not in fetched]
+        for (tid, _), out in zip(misses, outs):
+            if isinstance(out, BaseException):
+                print(f"[{now_iso()}] triage failed for thread {tid}: {out}")
+                retry.append(tid)
             else:
-                # fallback if messages metadata missing for some reason
-                subject = th.get("snippet") or "(no subject)"
-
-            # Check if the thread has changed since last poll, and skip triage if not
-            if latest_history_id and (not store.should_analyze_thread(conn, "gmail", tid, latest_history_id)):
-                continue
-
-            store.upsert_thread(conn, "gmail", tid, subject, now_iso(), latest_history_id or "")
-            msgs = fetch_thread_messages_text(svc, user, tid, max_messages=6)
-            out = triage_thread(subject, msgs, schema)
-            store.record_triage(conn, "gmail", tid, now_iso(), os.getenv("LLM_MODEL","simulate"), float(out["confidence"]), latest_history_id or "", out)
-            if out.get("priority") == "ignore" and out.get("confidence",0) >= conf_thr:
-                continue
-            store.create_tasks_from_actions(conn, "gmail", tid, now_iso(), out)
-            
+                fresh[tid] = out
+        if len(fresh) < len(misses):
+            # Failed threads are left unrecorded, so the next cycle retries them
+            work = [m for m in work if m[0] in fresh or keys[m[0]] in cached]
+        if cached:
+            print(f"[{now_iso()}] triage cache hits: {len(keys) - len(misses)}")
+
+        # Store writes stay on this thread and the whole run commits as one transaction
+        now = now_iso()
+        version = schema_version(schema)
+        with store.transaction(conn):
+            store.prune_triage_cache(conn, version, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - cache_days*86400)))
+            for tid, subject, latest_history_id in work:
+                out = fresh.get(tid)
+                if out is None:
+                    out = cached[keys[tid]]
+                elif out.get("priority") != "urgent":
+                    # urgent verdicts are time-sensitive; always re-ask for those
+                    store.save_cached_triage(conn, keys[tid], version, now, out)
+                store.upsert_thread(conn, "gmail", tid, subject, now, latest_history_id or "")
+                if out.get("priority") == "ignore" and out.get("confidence",0) >= conf_thr:
+                    store.record_triage_compact(conn, "gmail", tid, now, llm_model, float(out["confidence"]), latest_history_id or "", out)
+                    continue
+                store.record_triage(conn, "gmail", tid, now, llm_model, float(out["confidence"]), latest_history_id or "", out)
+                store.create_tasks_from_actions(conn, "gmail", tid, now, out)
+        return len(work), retry
+
+    def run(coro):
+        # to_thread uses the loop's default pool, which is capped at cpu+4 threads
+        async def with_pool():
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=triage_concurrency))
+            return await coro
+        return asyncio.run(with_pool())
+
+    def digest_html() -> str | None:
+        # Reads happen here, on the DB thread; only the HTTPS send may move off it
         tasks = store.fetch_open_tasks(conn)
         print(f"[{now_iso()}] open tasks: {len(tasks)}")
-        if send_digest:
-            html = render_digest(tasks)
-            send_digest_via_gmail_api(svc, user, digest_to_email, f"[{digest_subject_prefix}] Daily Action Digest", html)
-            print(f"[{now_iso()}] digest sent to {digest_to_email}")
+        return render_digest(tasks) if send_digest else None
+
+    def send_html(service, html: str):
+        send_digest_via_gmail_api(service, user, digest_to_email, f"{digest_tag} Daily Action Digest", html)
+        print(f"[{now_iso()}] digest sent to {digest_to_email}")
+
+    def deliver_digest():
+        html = digest_html()
+        if html is not None:
+            send_html(svc, html)
+
+    def scan():
+        return process_threads(fetch_recent_threads(svc, user, lookback_days=lookback_days, max_threads=max_threads, headers_only=headers_only))
+
+    def cycle() -> int:
+        # Failures need no bookkeeping here: their threads stay unrecorded, so the
+        # next scan's query finds them again
+        n, _ = run(scan())
+        deliver_digest()
+        return n
+
+    def cycle_incremental(since_history_id: str) -> Tuple[str | None, Dict[str, int]]:
+        # Only threads that gained INBOX messages since the stored cursor are fetched,
+        # plus those an earlier sync failed to fetch or triage: the cursor moves past
+        # them, so they are carried in sync_state (thread id -> failed attempts)
+        pending = json.loads(store.get_sync_state(conn, "gmail", "retry_thread_ids") or "{}")
+        tids, new_history_id = fetch_history_thread_ids(svc, user, since_history_id)
+        if tids is None:
+            print(f"[{now_iso()}] history {since_history_id} expired; running a full scan")
+            return None, pending
+        print(f"[{now_iso()}] history {since_history_id}..{new_history_id}: {len(tids)} changed threads, {len(pending)} to retry")
+        tids = list(dict.fromkeys(tids + list(pending)))
+        n, failed = run(process_threads(fetch_threads(svc, user, tids, headers_only=headers_only), requested=tids)) if tids else (0, [])
+        if n:
+            deliver_digest()
+        retry = {}
+        for tid in failed:
+            attempts = pending.get(tid, 0) + 1
+            if attempts > WATCH_MAX_RETRIES:
+                print(f"[{now_iso()}] giving up on thread {tid} after {attempts} failed syncs")
+            else:
+                retry[tid] = attempts
+        return new_history_id, retry
+
+    def watch():
+        topic = os.getenv("PUBSUB_TOPIC", "").strip()
+        subscription = os.getenv("PUBSUB_SUBSCRIPTION", "").strip()
+        if not (topic and subscription):
+            raise RuntimeError("Set PUBSUB_TOPIC and PUBSUB_SUBSCRIPTION in .env to use --watch")
+        try:
+            from google.cloud import pubsub_v1
+        except ImportError:
+            raise RuntimeError("--watch needs google-cloud-pubsub (pip install google-cloud-pubsub)")
+
+        def renew() -> str:
+            res = start_watch(svc, user, topic)
+            print(f"[{now_iso()}] watch active on {topic} (historyId {res['historyId']})")
+            return str(res["historyId"])
+
+        watch_history_id = renew()
+        renewed_at = time.monotonic()
+
+        def sync(sid: str):
+            nonlocal renewed_at
+            new_sid, retry = cycle_incremental(sid)
+            if new_sid is None:
+                new_sid = renew()
+                renewed_at = time.monotonic()
+                cycle()
+            # Cursor and retry list move together, so no failed thread is skipped over
+            with store.transaction(conn):
+                store.set_sync_state(conn, "gmail", "history_id", new_sid)
+                store.set_sync_state(conn, "gmail", "retry_thread_ids", json.dumps(retry))
+
+        sid = store.get_sync_state(conn, "gmail", "history_id")
+        if not sid:
+            # First run: catch up with a normal scan, then follow history from here on
+            cycle()
+            with store.transaction(conn):
+                store.set_sync_state(conn, "gmail", "history_id", watch_history_id)
+        else:
+            # Restart: pick up mail that arrived while we were down without waiting for a push
+            sync(sid)
+
+        # Pub/Sub callbacks run on subscriber threads; hand them to this thread so
+        # SQLite and the Gmail client are only ever touched from one place.
+        pushes = queue.Queue()
+        def on_push(message):
+            pushes.put(None)
+            message.ack()
+
+        subscriber = pubsub_v1.SubscriberClient()
+        future = subscriber.subscribe(subscription, callback=on_push)
+        with subscriber:
+            try:
+                while True:
+                    try:
+                        pushes.get(timeout=WATCH_CHECK_S)
+                    except queue.Empty:
+                        pass
+                    else:
+                        # Coalesce bursts: one history sync covers every queued push
+                        while not pushes.empty():
+                            pushes.get_nowait()
+                        sync(store.get_sync_state(conn, "gmail", "history_id"))
+                    if future.done():
+                        # The streaming pull died (bad subscription, permissions, ...):
+                        # raise its error rather than wait for pushes that never come
+                        future.result()
+                        raise RuntimeError(f"Pub/Sub subscription {subscription} stopped")
+                    if time.monotonic() - renewed_at > WATCH_RENEW_S:
+                        renew()
+                        renewed_at = time.monotonic()
+            finally:
+                future.cancel()
+
+    async def poll_loop():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=triage_concurrency))
+        # The send runs on a worker thread while the next cycle starts, and httplib2
+        # is not thread-safe, so it gets its own Gmail service
+        digest_svc = gmail_service(creds) if send_digest else None
+        sending = None
+        # Back off while the inbox is idle (up to an hour), snap back once mail arrives
+        base_sleep = max(60, args.interval_min*60)
+        sleep_s = base_sleep
+        try:
+            while True:
+                n, _ = await scan()
+                if sending is not None:
+                    await sending  # one send in flight at a time; surfaces its errors
+                    sending = None
+                html = digest_html()
+                if html is not None:
+                    sending = asyncio.create_task(asyncio.to_thread(send_html, digest_svc, html))
+                if n == 0:
+                    sleep_s = min(sleep_s*2, max(base_sleep, POLL_MAX_SLEEP_S))
+                else:
+                    sleep_s = base_sleep
+                await asyncio.sleep(sleep_s + random.uniform(0, sleep_s*0.1))
+        finally:
+            # Ctrl-C or an error: let an in-flight digest finish rather than drop it
+            if sending is not None:
+                await sending
 
     if args.run_once:
         cycle(); return
+    if args.watch:
+        watch(); return
     if args.poll:
-        while True:
-            cycle()
-            time.sleep(max(60, args.interval_min*60))
+        asyncio.run(poll_loop()); return
     else:
         p.print_help()
 
@@ -1,24 +1,97 @@
-import base64, datetime as dt
+import base64, datetime as dt, re
 from email.mime.text import MIMEText
-from typing import Dict, Any, List
+from functools import lru_cache
+from typing import Dict, Any, Iterator, List, Mapping, Tuple
 import os
 
-def _esc(s: str) -> str:
-    return (s or "").replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+_PR_RANK = {"urgent": 0, "high": 1, "normal": 2, "ignore": 3}
+
+# due_date is YYYY-MM-DD per the schema; anything else is rejected without raising
+_ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+_ESC_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+# Static markup is kept in module-level templates; render_digest only fills them in
+_PAGE_HEAD = """
+    <div style="font-family:ui-sans-serif,system-ui; line-height:1.35; color:#111827">
+      <h2 style="margin:0 0 6px">Daily Action Digest</h2>
+      <div style="color:#6b7280;margin-bottom:10px">{date}</div>
+
+      <div style="margin:10px 0 4px;color:#111827"><b>Bucket review</b> <span style="color:#6b7280">(counts)</span></div>
+      <div>"""
+
+_PAGE_MID = """</div>
+
+      """
+
+_PAGE_TAIL = """
+
+      <p style="color:#6b7280;margin-top:10px;font-size:12px">
+        Generated locally. Click “Open” to jump directly to the Gmail thread.
+      </p>
+    </div>
+    """
+
+_PAGE_EMPTY = """
+    <div style="font-family:ui-sans-serif,system-ui; line-height:1.35; color:#111827">
+      <h2 style="margin:0 0 6px">Daily Action Digest</h2>
+      <div style="color:#6b7280;margin-bottom:10px">{date}</div>
+      <p>No open tasks ✅</p>
+    </div>
+    """
+
+_PILL = ("<span style='display:inline-block;margin:0 8px 8px 0;padding:6px 10px;border:1px solid #e5e7eb;border-radius:999px;background:#f8fafc'>"
+         "<b>{label}:</b> {n}"
+         "</span>")
+
+_SECTION_HEAD = """
+        <details{open} style="margin:10px 0;border:1px solid #e5e7eb;border-radius:14px;background:#ffffff;">
+          <summary style="padding:10px 12px;cursor:pointer;background:#f8fafc;border-radius:14px;">
+            <b>{label}</b> <span style="color:#6b7280">({n})</span>
+          </summary>
+          <div style="padding:10px 12px;">
+            <table cellpadding="8" cellspacing="0" style="border-collapse:collapse;width:100%;border:1px solid #e5e7eb">
+              <thead>
+                <tr style="background:#f8fafc">
+                  <th align="left">ID</th>
+                  <th align="left">Priority</th>
+                  <th align="left">Task + Subject</th>
+                  <th align="left">Due</th>
+                  <th align="left">Link</th>
+                </tr>
+              </thead>
+              <tbody>
+                """
+
+_SECTION_TAIL = """
+              </tbody>
+            </table>
+          </div>
+        </details>
+        """
 
-def _parse_date(s: str):
-    try:
-        return dt.date.fromisoformat(s)
-    except Exception:
-        return None
+_ROW = ("<tr>"
+        "<td>{id}</td>"
+        "<td>{pr}</td>"
+        "<td>{title}<div style='color:#6b7280;font-size:12px;margin-top:2px'>{subj}</div></td>"
+        "<td>{due}</td>"
+        "<td><a href='{link}'>Open</a></td>"
+        "</tr>")
 
-def _days_until(d: dt.date):
-    return (d - dt.date.today()).days
+def _esc(s: str) -> str:
+    return (s or "").translate(_ESC_TABLE)
 
-def _load_domains() -> List[str]:
+# env is loaded once at startup, so the parsed values are cached for the process
+@lru_cache(maxsize=1)
+def _load_domains() -> Tuple[str, ...]:
     raw = os.getenv("DOMAINS", "").strip()
-    return [d.strip().lower() for d in raw.split(",") if d.strip()] if raw else []
+    return tuple(d.strip().lower() for d in raw.split(",") if d.strip()) if raw else ()
+
+@lru_cache(maxsize=1)
+def _bucket_order() -> Tuple[str, ...]:
+    return ("urgent",) + _load_domains() + ("review",)
 
+@lru_cache(maxsize=1)
 def _load_bucket_labels() -> Dict[str, str]:
     raw = os.getenv("BUCKET_LABELS", "").strip()
     labels = {}
@@ -36,26 +109,19 @@ def _bucket_label(key: str, labels: Dict[str, str]) -> str:
     if key == "review": return "Review Needed"
     return labels.get(key, key.replace("_"," ").replace("-"," ").title())
 
-def _compute_bucket(t: Dict[str, Any], allowed_domains: set) -> str:
-    # Priority override: urgent bucket if due soon or marked urgent
-    due = _parse_date(t.get("due_date") or "")
-    if t.get("priority") == "urgent":
-        return "urgent"
-    if due is not None and _days_until(due) <= 3:
-        return "urgent"
-
-    # If triage thought it's ambiguous, you may have tasks titled "Review..."
-    title = (t.get("title") or "").lower()
-    if "review" in title or "unclear" in (t.get("notes") or "").lower():
-        return "review"
-
-    # Otherwise bucket by triage domain stored on thread
-    b = (t.get("bucket") or "other").lower()
-    if b in allowed_domains:
-        return b
-    return os.getenv("DOMAIN_DEFAULT", "other").strip().lower() or "other"
-
-def render_digest(tasks: List[Dict[str, Any]]) -> str:
+def _task_sort_key(t: Mapping[str, Any]):
+    pr = (t["priority"] or "normal").lower()
+    return (_PR_RANK.get(pr, 9), t["due_date"] or "9999-12-31")
+
+def render_digest(tasks: List[Mapping[str, Any]]) -> str:
+    date = dt.date.today().strftime('%B %d, %Y')
+    # Nothing open (typical first thing in the day): skip bucketing entirely
+    if not tasks:
+        return _PAGE_EMPTY.format(date=date)
+    # str.join over a generator: pieces are produced and concatenated in one pass
+    return "".join(_iter_digest(tasks, date))
+
+def _iter_digest(tasks: List[Mapping[str, Any]], date: str) -> Iterator[str]:
     # retreive custom domains from env file.
     domains = _load_domains()
     allowed_domains = set(domains)
@@ -63,99 +129,71 @@ def render_digest(tasks: List[Dict[str, Any]]) -> str:
     labels = _load_bucket_labels()
 
     # Group tasks into buckets
-    buckets_order = ["urgent"] + domains + ["review"]
-    groups: Dict[str, List[Dict[str, Any]]] = {k: [] for k in buckets_order}
-
-    for t in tasks:
-        k = _compute_bucket(t, allowed_domains)
+    buckets_order = _bucket_order()
+    groups: Dict[str, List[Mapping[str, Any]]] = {k: [] for k in buckets_order}
+
+    # Per-render constants bound as locals for the per-task bucketing below
+    today = dt.date.today()
+    fromiso = dt.date.fromisoformat
+    iso_date = _ISO_DATE.fullmatch
+    default_bucket = os.getenv("DOMAIN_DEFAULT", "other").strip().lower() or "other"
+
+    def bucket_for(t: Mapping[str, Any]) -> str:
+        # Priority override: urgent bucket if due soon or marked urgent
+        if t["priority"] == "urgent":
+            return "urgent"
+        due = t["due_date"]
+        if due and iso_date(due):
+            try:
+                if (fromiso(due) - today).days <= 3:
+                    return "urgent"
+            except (TypeError, ValueError):
+                pass
+
+        # If triage thought it's ambiguous, you may have tasks titled "Review..."
+        title = (t["title"] or "").lower()
+        if "review" in title or "unclear" in (t["notes"] or "").lower():
+            return "review"
+
+        # Otherwise bucket by triage domain stored on thread
+        b = (t["bucket"] or "other").lower()
+        return b if b in allowed_domains else default_bucket
+
+    # Sort once up front (stable, so DB order breaks ties); each bucket then
+    # receives its tasks already in order
+    for t in sorted(tasks, key=_task_sort_key):
+        k = bucket_for(t)
         if k in groups:
             groups[k].append(t)
 
-    # sort groups incase query or sorting changes in DB
-    def sort_key(t):
-        pr = (t.get("priority") or "normal").lower()
-        pr_rank = {"urgent":0, "high":1, "normal":2, "ignore":3}.get(pr, 9)
-        due = t.get("due_date") or "9999-12-31"
-        return (pr_rank, due)
-
-    for k in groups:
-        groups[k].sort(key=sort_key)
-
-    # Helper to build table rows
-    def rows_for(items: List[Dict[str, Any]]) -> str:
-        out = []
-        for t in items[:80]:
-            due = _esc(t.get("due_date") or "—")
-            subj = _esc(t.get("thread_subject") or "—")
-            thr = t.get("thread_id")
-            link = f"https://mail.google.com/mail/u/0/#all/{thr}" if thr else "#"
-            out.append(
-                "<tr>"
-                f"<td>{_esc(str(t.get('id') or ''))}</td>"
-                f"<td>{_esc(t.get('priority') or '')}</td>"
-                f"<td>{_esc(t.get('title') or '')}<div style='color:#6b7280;font-size:12px;margin-top:2px'>{subj}</div></td>"
-                f"<td>{due}</td>"
-                f"<td><a href='{link}'>Open</a></td>"
-                "</tr>"
-            )
-        return "".join(out) if out else "<tr><td colspan='5'>No items ✅</td></tr>"
+    yield _PAGE_HEAD.format(date=date)
 
     # Summary counts for reviewing bucket quality
-    counts_html = "".join([
-        f"<span style='display:inline-block;margin:0 8px 8px 0;padding:6px 10px;border:1px solid #e5e7eb;border-radius:999px;background:#f8fafc'>"
-        f"<b>{_esc(_bucket_label(k, labels))}:</b> {len(groups[k])}"
-        f"</span>"
-        for k in buckets_order
-    ])
-
-    sections = []
     for k in buckets_order:
-        label = _bucket_label(k, labels)
-        n = len(groups[k])
+        yield _PILL.format(label=_esc(_bucket_label(k, labels)), n=len(groups[k]))
+    yield _PAGE_MID
+
+    for k in buckets_order:
+        items = groups[k]
         # clean up digest by hiding empty buckets.
-        if n == 0:
+        if not items:
             continue
         # Open urgent + review by default so you can “review the buckets” quickly
         open_attr = " open" if k in ("urgent","review") else ""
-        sections.append(f"""
-        <details{open_attr} style="margin:10px 0;border:1px solid #e5e7eb;border-radius:14px;background:#ffffff;">
-          <summary style="padding:10px 12px;cursor:pointer;background:#f8fafc;border-radius:14px;">
-            <b>{_esc(label)}</b> <span style="color:#6b7280">({n})</span>
-          </summary>
-          <div style="padding:10px 12px;">
-            <table cellpadding="8" cellspacing="0" style="border-collapse:collapse;width:100%;border:1px solid #e5e7eb">
-              <thead>
-                <tr style="background:#f8fafc">
-                  <th align="left">ID</th>
-                  <th align="left">Priority</th>
-                  <th align="left">Task + Subject</th>
-                  <th align="left">Due</th>
-                  <th align="left">Link</th>
-                </tr>
-              </thead>
-              <tbody>
-                {rows_for(groups[k])}
-              </tbody>
-            </table>
-          </div>
-        </details>
-        """)
-
-    return f"""
-    <div style="font-family:ui-sans-serif,system-ui; line-height:1.35; color:#111827">
-      <h2 style="margin:0 0 6px">Daily Action Digest</h2>
-      <div style="color:#6b7280;margin-bottom:10px">{dt.date.today().strftime('%B %d, %Y')}</div>
-
-      <div style="margin:10px 0 4px;color:#111827"><b>Bucket review</b> <span style="color:#6b7280">(counts)</span></div>
-      <div>{counts_html}</div>
-
-      {"".join(sections)}
-
-      <p style="color:#6b7280;margin-top:10px;font-size:12px">
-        Generated locally. Click “Open” to jump directly to the Gmail thread.
-      </p>
-    </div>
-    """
+        yield _SECTION_HEAD.format(open=open_attr, label=_esc(_bucket_label(k, labels)), n=len(items))
+        for t in items[:80]:
+            thr = t["thread_id"]
+            yield _ROW.format_map({
+                "id": _esc(str(t["id"] or "")),
+                "pr": _esc(t["priority"] or ""),
+                "title": _esc(t["title"] or ""),
+                "subj": _esc(t["thread_subject"] or "—"),
+                "due": _esc(t["due_date"] or "—"),
+                "link": f"https://mail.google.com/mail/u/0/#all/{thr}" if thr else "#",
+            })
+        yield _SECTION_TAIL
+
+    yield _PAGE_TAIL
 
 def send_digest_via_gmail_api(service, user_id: str, to_email: str, subject: str, html: str):
     msg = MIMEText(html, "html", "utf-8")
@@ -1,10 +1,19 @@
 import base64
 import datetime as dt
-from typing import List, Dict, Any
+import os, tempfile
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.readonly",
@@ -24,71 +33,192 @@ def init_oauth(client_secret_path: str, token_path: str) -> Credentials:
     else:
         flow = InstalledAppFlow.from_client_secrets_file(client_secret_path, SCOPES)
         creds = flow.run_local_server(port=0)
-    with open(token_path, "w", encoding="utf-8") as f:
-        f.write(creds.to_json())
+    _write_token(token_path, creds.to_json())
     return creds
 
+def _write_token(token_path: str, new_json: str):
+    try:
+        with open(token_path, "r", encoding="utf-8") as f:
+            if f.read() == new_json:
+                return
+    except OSError:
+        pass
+    # Write-then-rename so a crash mid-write can't leave a truncated token behind
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(token_path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(new_json)
+        os.replace(tmp, token_path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+class OrjsonModel(JsonModel):
+    # Full-format thread responses are large; orjson parses them several times faster
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+        if self._data_wrapper and "data" in body:
+            body = body["data"]
+        return body
+
 def gmail_service(creds: Credentials):
-    return build("gmail", "v1", credentials=creds)
+    model = OrjsonModel() if orjson is not None else None
+    # One keep-alive connection per service, so only the first call pays the TLS
+    # handshake. httplib2 is not thread-safe: build one service per thread.
+    http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT_S))
+    # Use the discovery document bundled with google-api-python-client rather than
+    # fetching it from googleapis.com on every start (matters for cron --run-once)
+    return build("gmail", "v1", http=http, model=model, static_discovery=True)
+
+def headers_map(msg: Dict[str, Any]) -> Dict[str, str]:
+    # Lower-cased header name -> value, built once per message for O(1) lookups.
+    # Reversed so the first occurrence of a repeated header wins, as a linear scan would.
+    headers = (msg.get("payload", {}) or {}).get("headers", []) or []
+    return {(h.get("name", "") or "").lower(): h.get("value", "") or "" for h in reversed(headers)}
+
+def extract_subject_and_history_id(th: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    # Subject usually sits on the first message, historyId of the newest one is the
+    # thread's change marker. Only one header is needed, so scan rather than map.
+    msgs = th.get("messages", []) or []
+    if not msgs:
+        # fallback if messages metadata missing for some reason
+        return th.get("snippet") or "(no subject)", None
+    subject = ""
+    for h in (msgs[0].get("payload", {}) or {}).get("headers", []) or []:
+        if (h.get("name", "") or "").lower() == "subject":
+            subject = h.get("value", "") or ""
+            break
+    return subject or "(no subject)", msgs[-1].get("historyId")
 
 def _iso_from_ms(ms: str) -> str:
     ts = int(ms) / 1000.0
     return dt.datetime.fromtimestamp(ts).isoformat()
 
-def fetch_recent_threads(service, user_id: str, lookback_days: int = 2, max_threads: int = 50) -> List[Dict[str, Any]]:
+_b64decode = base64.urlsafe_b64decode
+
+HTTP_TIMEOUT_S = 30
+# Gmail caps a single batch HTTP request at 100 calls
+BATCH_LIMIT = 100
+METADATA_HEADERS = ["From","To","Cc","Subject","Date","Message-ID"]
+# Inbox tabs the full scan filters out with -category:promotions -category:social
+SKIP_CATEGORY_LABELS = frozenset({"CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL"})
+
+def fetch_recent_threads(service, user_id: str, lookback_days: int = 2, max_threads: int = 50, headers_only: bool = False) -> Iterator[Dict[str, Any]]:
     q = f"newer_than:{lookback_days}d -category:promotions -category:social -subject:'[EIMVP DIGEST]'"
     res = service.users().threads().list(userId=user_id, q=q, maxResults=max_threads).execute()
-    threads = res.get("threads", [])
-    out = []
-    for t in threads:
-        tid = t["id"]
-        th = service.users().threads().get(
-            userId=user_id, id=tid, format="metadata",
-            metadataHeaders=["From","To","Cc","Subject","Date","Message-ID"]
-        ).execute()
-        out.append(th)
-    return out
+    yield from fetch_threads(service, user_id, [t["id"] for t in res.get("threads", [])], headers_only=headers_only)
+
+def fetch_threads(service, user_id: str, tids: List[str], headers_only: bool = False) -> Iterator[Dict[str, Any]]:
+    # One get per thread carries subject, historyId and bodies alike, so callers
+    # read everything off it (thread_messages_text) instead of a second body fetch
+    kwargs = {"format": "metadata", "metadataHeaders": METADATA_HEADERS} if headers_only else {"format": "full"}
+    yield from _iter_threads_batched(service, user_id, tids, **kwargs)
+
+def _iter_threads_batched(service, user_id: str, tids: List[str], **get_kwargs) -> Iterator[Dict[str, Any]]:
+    # One HTTPS round-trip per 100 threads instead of one per thread. Each batch is
+    # yielded as soon as it lands, and the next one is only sent when the caller
+    # asks for more, so callers can start on early threads.
+    for i in range(0, len(tids), BATCH_LIMIT):
+        chunk = tids[i:i + BATCH_LIMIT]
+        by_id: Dict[str, Dict[str, Any]] = {}
+
+        def on_thread(request_id, response, exception):
+            if exception is not None:
+                print(f"[gmail] thread {request_id} fetch failed: {exception}")
+                return
+            by_id[request_id] = response
+
+        batch = service.new_batch_http_request(callback=on_thread)
+        for tid in chunk:
+            batch.add(service.users().threads().get(userId=user_id, id=tid, **get_kwargs), request_id=tid)
+        batch.execute()
+        for tid in chunk:
+            if tid in by_id:
+                yield by_id[tid]
+
+def start_watch(service, user_id: str, topic: str) -> Dict[str, Any]:
+    # Gmail stops pushing after 7 days unless watch() is called again
+    return service.users().watch(userId=user_id, body={"topicName": topic, "labelIds": ["INBOX"]}).execute()
+
+def fetch_history_thread_ids(service, user_id: str, start_history_id: str) -> Tuple[Optional[List[str]], Optional[str]]:
+    # Returns (thread ids with new INBOX messages, new cursor), or (None, None) when
+    # Gmail no longer keeps history that far back and a full scan is needed.
+    tids: Dict[str, None] = {}
+    latest = start_history_id
+    page_token = None
+    while True:
+        try:
+            res = service.users().history().list(
+                userId=user_id, startHistoryId=start_history_id, labelId="INBOX",
+                historyTypes=["messageAdded"], pageToken=page_token
+            ).execute()
+        except HttpError as e:
+            if e.resp.status == 404:
+                return None, None
+            raise
+        for h in res.get("history", []) or []:
+            for added in h.get("messagesAdded", []) or []:
+                m = added.get("message", {}) or {}
+                # Same exclusions as fetch_recent_threads' query: Promotions and Social
+                # mail is labelled INBOX too, but is never triaged
+                if SKIP_CATEGORY_LABELS.isdisjoint(m.get("labelIds", []) or []):
+                    tids[m["threadId"]] = None
+        latest = res.get("historyId", latest)
+        page_token = res.get("nextPageToken")
+        if not page_token:
+            return list(tids), latest
+
+def fetch_thread_messages_text(service, user_id: str, thread_id: str, max_messages: int = 6, headers_only: bool = False) -> List[Dict[str, Any]]:
+    # headers_only skips the bodies (a few KB instead of tens of KB per thread);
+    # Gmail's snippet stands in for the text
+    if headers_only:
+        th = service.users().threads().get(userId=user_id, id=thread_id, format="metadata", metadataHeaders=METADATA_HEADERS).execute()
+    else:
+        th = service.users().threads().get(userId=user_id, id=thread_id, format="full").execute()
+    return thread_messages_text(th, max_messages, headers_only)
+
+def _decode_data(data: str) -> str:
+    # urlsafe_b64decode takes the ASCII str directly; no intermediate bytes copy
+    return _b64decode(data).decode("utf-8", errors="ignore")
 
-def fetch_thread_messages_text(service, user_id: str, thread_id: str, max_messages: int = 6) -> List[Dict[str, Any]]:
-    th = service.users().threads().get(userId=user_id, id=thread_id, format="full").execute()
-    msgs = th.get("messages", [])[-max_messages:]
-
-    def get_header(headers, name):
-        for h in headers:
-            if h.get("name","").lower() == name.lower():
-                return h.get("value","")
-        return ""
-
-    def decode_part(part):
-        data = (part.get("body", {}) or {}).get("data")
-        if data:
-            return base64.urlsafe_b64decode(data.encode("utf-8")).decode("utf-8", errors="ignore")
-        return ""
-
-    def walk(payload):
-        if not payload:
-            return ""
-        if payload.get("mimeType") == "text/plain":
-            return decode_part(payload)
-        for p in payload.get("parts", []) or []:
-            txt = walk(p)
+def _body_text(payload: Dict[str, Any]) -> str:
+    # Iterative DFS over the MIME tree: the first non-empty text/plain part wins,
+    # otherwise fall back to the first other part carrying a body (usually text/html)
+    stack = [payload] if payload else []
+    fallback = None
+    while stack:
+        part = stack.pop()
+        data = (part.get("body") or {}).get("data")
+        if part.get("mimeType") == "text/plain":
+            if data:
+                txt = _decode_data(data)
+                if txt.strip():
+                    return txt
+            continue
+        if data and fallback is None:
+            txt = _decode_data(data)
             if txt.strip():
-                return txt
-        if (payload.get("body", {}) or {}).get("data"):
-            return decode_part(payload)
-        return ""
+                fallback = txt
+        parts = part.get("parts")
+        if parts:
+            stack.extend(reversed(parts))
+    return fallback or ""
 
+def thread_messages_text(th: Dict[str, Any], max_messages: int = 6, headers_only: bool = False) -> List[Dict[str, Any]]:
     out = []
-    for m in msgs:
+    for m in th.get("messages", [])[-max_messages:]:
         payload = m.get("payload", {}) or {}
-        headers = payload.get("headers", []) or []
+        hmap = headers_map(m)
         out.append({
             "message_id": m.get("id"),
             "internal_date": _iso_from_ms(m.get("internalDate","0")),
-            "from": get_header(headers, "From"),
-            "to": get_header(headers, "To"),
-            "subject": get_header(headers, "Subject"),
-            "date": get_header(headers, "Date"),
-            "text": walk(payload),
+            "from": hmap.get("from", ""),
+            "to": hmap.get("to", ""),
+            "subject": hmap.get("subject", ""),
+            "date": hmap.get("date", ""),
+            "text": m.get("snippet", "") if headers_only else _body_text(payload),
         })
     return out
@@ -1,9 +1,11 @@
-import sqlite3, json
-from typing import Any, Dict, List
-import hashlib
+import os, sqlite3, json
+from contextlib import contextmanager
+from typing import Any, Dict, List, Set
 
 SCHEMA = """
 PRAGMA journal_mode=WAL;
+-- WAL + NORMAL only fsyncs at checkpoints, not on every commit
+PRAGMA synchronous=NORMAL;
 
 CREATE TABLE IF NOT EXISTS threads (
   provider TEXT NOT NULL,
@@ -40,24 +42,110 @@ CREATE TABLE IF NOT EXISTS tasks (
   task_key TEXT NOT NULL
 );
 
-CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status);
+CREATE TABLE IF NOT EXISTS sync_state (
+  provider TEXT NOT NULL,
+  key TEXT NOT NULL,
+  value TEXT,
+  PRIMARY KEY (provider, key)
+);
+
+CREATE TABLE IF NOT EXISTS triage_cache (
+  cache_key TEXT PRIMARY KEY,
+  schema_version TEXT NOT NULL,
+  created_at TEXT NOT NULL,
+  output_json TEXT NOT NULL
+);
+
+-- Partial index over open tasks in digest order: fetch_open_tasks walks it instead
+-- of scanning + sorting. Its expressions must match that query's ORDER BY exactly.
+-- (Supersedes idx_tasks_status, which the planner would otherwise pick and then sort.)
+DROP INDEX IF EXISTS idx_tasks_status;
+CREATE INDEX IF NOT EXISTS idx_tasks_open_sort ON tasks(
+  (CASE priority WHEN 'urgent' THEN 0 WHEN 'high' THEN 1 WHEN 'normal' THEN 2 ELSE 3 END),
+  COALESCE(due_date,'9999-12-31')
+) WHERE status='open';
+CREATE INDEX IF NOT EXISTS idx_tasks_provider_thread ON tasks(provider, thread_id);
 CREATE INDEX IF NOT EXISTS idx_tasks_due ON tasks(due_date);
 CREATE UNIQUE INDEX IF NOT EXISTS ux_tasks_task_key ON tasks(task_key);
 """
 
+# Per-thread write statements, kept as module constants: sqlite3 caches compiled
+# statements by SQL text, so every cycle reuses the same prepared statements
+_SQL_UPSERT_THREAD = """
+  INSERT INTO threads(provider, thread_id, subject, last_seen_at, last_seen_history_id)
+  VALUES(?,?,?,?,?)
+  ON CONFLICT(provider, thread_id) DO UPDATE SET
+    subject=excluded.subject,
+    last_seen_at=excluded.last_seen_at,
+    last_seen_history_id=excluded.last_seen_history_id
+"""
+_SQL_INSERT_TRIAGE_RUN = """
+  INSERT INTO triage_runs(provider, thread_id, run_at, model, confidence, output_json)
+  VALUES(?,?,?,?,?,?)
+"""
+_SQL_SET_BUCKET = """
+  UPDATE threads SET last_analyzed_at=?, digest_bucket=?, last_analyzed_history_id=? WHERE provider=? AND thread_id=?
+"""
+_SQL_INSERT_TASK = """
+  INSERT OR IGNORE INTO tasks(provider, thread_id, created_at, priority, title, due_date, notes, task_key)
+  VALUES(?,?,?,?,?,?,?,?)
+"""
+_SQL_SAVE_CACHED_TRIAGE = """
+  INSERT OR REPLACE INTO triage_cache(cache_key, schema_version, created_at, output_json)
+  VALUES(?,?,?,?)
+"""
+
 def _task_key(provider: str, thread_id: str, title: str, due: str | None) -> str:
+    import hashlib  # only the write path needs it; keeps --list/--done startup lean
     base = f"{provider}|{thread_id}|{title.strip().lower()}|{(due or '').strip()}"
-    return hashlib.sha1(base.encode("utf-8")).hexdigest()
+    # Local dedup key, not a security boundary: blake2b is the cheapest hashlib digest
+    return hashlib.blake2b(base.encode("utf-8"), digest_size=16).hexdigest()
 
 def connect(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+    # Autocommit mode: the sqlite3 module opens no implicit transactions, so the only
+    # ones are the explicit transaction() blocks below. timeout is SQLite's busy
+    # timeout (5s).
+    conn = sqlite3.connect(db_path, isolation_level=None, timeout=5.0)
+    # Rows support both row[0] and row["col"] without building a dict per row
+    conn.row_factory = sqlite3.Row
+    if os.getenv("SQL_TRACE","false").lower() == "true":
+        # Debug aid: echo every statement SQLite actually executes
+        conn.set_trace_callback(lambda sql: print(f"[sql] {sql.strip()}"))
     conn.execute("PRAGMA foreign_keys=ON;")
     conn.executescript(SCHEMA)
+    _migrate(conn)
     return conn
 
+# Bump when stored data needs rewriting; tracked in PRAGMA user_version
+SCHEMA_VERSION = 1
+
+def _migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    with transaction(conn):
+        if version < 1:
+            # task_key moved from sha1 to blake2b; rehash so re-triaged threads still dedup
+            rows = conn.execute("SELECT id, provider, thread_id, title, due_date FROM tasks WHERE length(task_key)=40").fetchall()
+            conn.executemany("UPDATE tasks SET task_key=? WHERE id=?",
+                             [(_task_key(p, tid, title, due), i) for i, p, tid, title, due in rows])
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+# Helpers never commit; callers group a whole cycle's writes into one of these
+@contextmanager
+def transaction(conn):
+    # IMMEDIATE takes the write lock up front, so a concurrent --list/--done waits in
+    # busy_timeout instead of failing mid-transaction on lock upgrade
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
 def mark_task_done(conn, task_id: int):
     conn.execute("UPDATE tasks SET status='done' WHERE id=?", (task_id,))
-    conn.commit()
 
 # Helper to decide whether thread needs re-analysis
 def should_analyze_thread(conn, provider: str, thread_id: str, latest_history_id: str) -> bool:
@@ -72,43 +160,79 @@ def should_analyze_thread(conn, provider: str, thread_id: str, latest_history_id
     last_analyzed = row[0]
     return (last_analyzed is None) or (str(last_analyzed) != str(latest_history_id))
 
-def upsert_thread(conn, provider: str, thread_id: str, subject: str, last_seen_at: str, last_seen_history_id: str):
+# Batched form of should_analyze_thread: one query per chunk instead of one per thread
+def fetch_analyzed_history_ids(conn, provider: str, tids: List[str]) -> Dict[str, str | None]:
+    known: Dict[str, str | None] = {}
+    for i in range(0, len(tids), 500):  # stay under SQLite's bound-parameter limit
+        chunk = tids[i:i + 500]
+        cur = conn.execute(f"""
+          SELECT thread_id, last_analyzed_history_id
+          FROM threads
+          WHERE provider=? AND thread_id IN ({",".join("?" * len(chunk))})
+        """, (provider, *chunk))
+        known.update(cur.fetchall())
+    return known
+
+def filter_threads_needing_analysis(conn, provider: str, tid_to_hid: Dict[str, str]) -> Set[str]:
+    known = fetch_analyzed_history_ids(conn, provider, list(tid_to_hid))
+    return {tid for tid, hid in tid_to_hid.items()
+            if known.get(tid) is None or str(known[tid]) != str(hid)}
+
+def fetch_cached_triage(conn, cache_keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    found: Dict[str, Dict[str, Any]] = {}
+    for i in range(0, len(cache_keys), 500):
+        chunk = cache_keys[i:i + 500]
+        cur = conn.execute(f"""
+          SELECT cache_key, output_json FROM triage_cache
+          WHERE cache_key IN ({",".join("?" * len(chunk))})
+        """, chunk)
+        found.update((k, json.loads(v)) for k, v in cur.fetchall())
+    return found
+
+def save_cached_triage(conn, cache_key: str, schema_version: str, created_at: str, output: Dict[str, Any]):
+    conn.execute(_SQL_SAVE_CACHED_TRIAGE, (cache_key, schema_version, created_at, json.dumps(output, ensure_ascii=False)))
+
+def prune_triage_cache(conn, schema_version: str, older_than: str):
+    # Entries from another schema can never hit again (the version is part of the key)
+    conn.execute("DELETE FROM triage_cache WHERE schema_version != ? OR created_at < ?", (schema_version, older_than))
+
+def get_sync_state(conn, provider: str, key: str) -> str | None:
+    row = conn.execute("SELECT value FROM sync_state WHERE provider=? AND key=?", (provider, key)).fetchone()
+    return row[0] if row else None
+
+def set_sync_state(conn, provider: str, key: str, value: str):
     conn.execute("""
-      INSERT INTO threads(provider, thread_id, subject, last_seen_at, last_seen_history_id)
-      VALUES(?,?,?,?,?)
-      ON CONFLICT(provider, thread_id) DO UPDATE SET
-        subject=excluded.subject,
-        last_seen_at=excluded.last_seen_at,
-        last_seen_history_id=excluded.last_seen_history_id
-    """, (provider, thread_id, subject, last_seen_at, last_seen_history_id))
-    conn.commit()
+      INSERT INTO sync_state(provider, key, value) VALUES(?,?,?)
+      ON CONFLICT(provider, key) DO UPDATE SET value=excluded.value
+    """, (provider, key, value))
+
+def upsert_thread(conn, provider: str, thread_id: str, subject: str, last_seen_at: str, last_seen_history_id: str):
+    conn.execute(_SQL_UPSERT_THREAD, (provider, thread_id, subject, last_seen_at, last_seen_history_id))
 
 def record_triage(conn, provider: str, thread_id: str, run_at: str, model: str, confidence: float, latest_history_id: str, output: Dict[str, Any]):
-    conn.execute("""
-      INSERT INTO triage_runs(provider, thread_id, run_at, model, confidence, output_json)
-      VALUES(?,?,?,?,?,?)
-    """, (provider, thread_id, run_at, model, confidence, json.dumps(output, ensure_ascii=False)))
-    conn.execute("""
-      UPDATE threads SET last_analyzed_at=?, digest_bucket=?, last_analyzed_history_id=? WHERE provider=? AND thread_id=?
-    """, (run_at, output.get("domain","other"),latest_history_id, provider, thread_id))
-    conn.commit()
+    conn.execute(_SQL_INSERT_TRIAGE_RUN, (provider, thread_id, run_at, model, confidence, json.dumps(output, ensure_ascii=False)))
+    conn.execute(_SQL_SET_BUCKET, (run_at, output.get("domain","other"),latest_history_id, provider, thread_id))
+
+def record_triage_compact(conn, provider: str, thread_id: str, run_at: str, model: str, confidence: float, latest_history_id: str, output: Dict[str, Any]):
+    # Confidently ignored threads: keep the audit row and bucket, not the whole LLM output
+    stub = {"priority": output.get("priority"), "confidence": confidence, "domain": output.get("domain","other")}
+    record_triage(conn, provider, thread_id, run_at, model, confidence, latest_history_id, stub)
 
 def create_tasks_from_actions(conn, provider: str, thread_id: str, created_at: str, triage_output: Dict[str, Any]):
     pr = triage_output.get("priority","normal")
+    rows = []
     for a in triage_output.get("recommended_actions", []):
         if a.get("action") not in ("create_task","send_reminder","review_needed"):
             continue
         title = a.get("title") or "Follow up"
         notes = a.get("notes") or triage_output.get("rationale","")
         due = a.get("due_date")
-        key = _task_key(provider, thread_id, title, due)
-        conn.execute("""
-          INSERT OR IGNORE INTO tasks(provider, thread_id, created_at, priority, title, due_date, notes, task_key)
-          VALUES(?,?,?,?,?,?,?,?)
-        """, (provider, thread_id, created_at, pr, title, due, notes, key))
-    conn.commit()
-
-def fetch_open_tasks(conn) -> List[Dict[str, Any]]:
+        rows.append((provider, thread_id, created_at, pr, title, due, notes, _task_key(provider, thread_id, title, due)))
+    if rows:
+        conn.executemany(_SQL_INSERT_TASK, rows)
+
+def fetch_open_tasks(conn, limit: int | None = None) -> List[sqlite3.Row]:
+    # WHERE/ORDER BY mirror idx_tasks_open_sort; keep them in sync
     cur = conn.execute("""
       SELECT 
         t.id, 
@@ -129,6 +253,6 @@ def fetch_open_tasks(conn) -> List[Dict[str, Any]]:
       ORDER BY
         CASE priority WHEN 'urgent' THEN 0 WHEN 'high' THEN 1 WHEN 'normal' THEN 2 ELSE 3 END,
         COALESCE(due_date,'9999-12-31') ASC
-    """)
-    cols = [c[0] for c in cur.description]
-    return [dict(zip(cols, row)) for row in cur.fetchall()]
+      LIMIT ?
+    """, (-1 if limit is None else limit,))
+    return cur.fetchall()